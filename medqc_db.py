@@ -1,19 +1,98 @@
 # medqc_db.py
 # ВАРИАНТ А: слой БД всегда возвращает dict (Row→dict), плюс ensure_schema()
 
+import os
+import json
+import atexit
 import sqlite3
+import functools
+import threading
 from contextlib import contextmanager
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional
+
+# =========================
+# JSON
+# =========================
+
+# orjson — необязательная зависимость: C-сериализатор без экранирования кириллицы.
+# Запасной вариант даёт тот же компактный вывод; ключи-не-строки допустимы в обоих
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    json_loads = json.loads
 
 # =========================
 # Подключение и row_factory
 # =========================
 
-def connect(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+# настройки соединения; page_size — свойство файла БД, задаётся при создании схемы (ensure_schema)
+CONN_PRAGMAS_SQL = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+"""
+
+# одно соединение на (поток, файл БД): PRAGMA выполняются один раз, кэш страниц не теряется.
+# Кэш у каждого потока свой, соединения между потоками через него не делятся.
+# Закрытое вызывающим соединение подменяется новым; кэш потока закрывается при его
+# завершении, кэш главного потока — при выходе процесса
+class _ThreadConns(dict):
+    def close_all(self) -> None:
+        for conn in self.values():
+            conn.close()
+        self.clear()
+
+    def __del__(self):
+        self.close_all()
+
+_tls = threading.local()
+
+def _open(db_path: str) -> sqlite3.Connection:
+    # соединение долгоживущее (API) — кэш подготовленных выражений побольше стандартных 128
+    conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=512)
     conn.row_factory = sqlite3.Row
+    conn.executescript(CONN_PRAGMAS_SQL)
+    return conn
+
+def _is_open(conn: sqlite3.Connection) -> bool:
+    try:
+        conn.total_changes  # у закрытого соединения — ProgrammingError
+        return True
+    except sqlite3.ProgrammingError:
+        return False
+
+def connect(db_path: str) -> sqlite3.Connection:
+    if db_path in ("", ":memory:"):
+        return _open(db_path)  # у каждой такой БД своё содержимое — не кэшируем
+    conns = getattr(_tls, "conns", None)
+    if conns is None:
+        conns = _tls.conns = _ThreadConns()
+    key = os.path.abspath(db_path)
+    conn = conns.get(key)
+    if conn is None or not _is_open(conn):
+        conn = conns[key] = _open(db_path)
     return conn
 
+def close_connections() -> None:
+    """Закрывает соединения, закэшированные connect() в текущем потоке."""
+    conns = getattr(_tls, "conns", None)
+    if conns is not None:
+        conns.close_all()
+
+atexit.register(close_connections)
+
+def db_file(conn: sqlite3.Connection) -> str:
+    # абсолютный путь к файлу основной БД соединения ("" — БД в памяти/временная)
+    return conn.execute("PRAGMA database_list").fetchone()[2] or ""
+
 @contextmanager
 def get_cursor(conn: sqlite3.Connection):
     cur = conn.cursor()
@@ -35,6 +114,10 @@ def row_to_dict(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
         return row  # type: ignore[return-value]
 
 def rows_to_dicts(rows: Iterable[sqlite3.Row]) -> List[Dict[str, Any]]:
+    rows = rows if isinstance(rows, list) else list(rows)
+    # обычный случай (fetchall с row_factory=Row): dict(r) напрямую, без проверок на каждой строке
+    if rows and isinstance(rows[0], sqlite3.Row):
+        return [dict(r) for r in rows]
     return [row_to_dict(r) for r in rows if r is not None]  # type: ignore[list-item]
 
 # =========================
@@ -121,6 +204,8 @@ CREATE TABLE IF NOT EXISTS rules (
 
 CREATE INDEX IF NOT EXISTS idx_rules_profile ON rules(profile);
 CREATE INDEX IF NOT EXISTS idx_rules_enabled ON rules(enabled);
+-- list_rules_for_profile / list_all_rules: поиск по (enabled, profile) сразу в порядке rule_id, без сортировки
+CREATE INDEX IF NOT EXISTS idx_rules_enabled_profile ON rules(enabled, profile, rule_id);
 
 CREATE TABLE IF NOT EXISTS rule_applications (
   id           INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -158,9 +243,27 @@ CREATE TABLE IF NOT EXISTS doc_stats (
 );
 """
 
+# версия SCHEMA_SQL в PRAGMA user_version; при изменении схемы — увеличить
+SCHEMA_VERSION = 2
+
+# размер страницы новой БД. В WAL page_size не меняется даже VACUUM'ом, а connect() уже включил
+# WAL — поэтому пустую БД на время смены размера переводим в DELETE и обратно
+PAGE_SIZE = 8192
+
 def ensure_schema(conn: sqlite3.Connection) -> None:
+    # схема этой версии уже применена — не гоняем DDL повторно
+    # (foreign_keys — настройка соединения, её включаем всегда)
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        conn.execute("PRAGMA foreign_keys=ON")
+        return
     with get_cursor(conn) as cur:
+        empty = cur.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None
+        if empty and cur.execute("PRAGMA page_size").fetchone()[0] != PAGE_SIZE:
+            mode = cur.execute("PRAGMA journal_mode").fetchone()[0]
+            cur.executescript(f"PRAGMA journal_mode=DELETE; PRAGMA page_size={PAGE_SIZE}; VACUUM;")
+            cur.execute(f"PRAGMA journal_mode={mode}")
         cur.executescript(SCHEMA_SQL)
+        cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
         conn.commit()
 
 # =========================
@@ -173,17 +276,40 @@ def get_doc(conn: sqlite3.Connection, doc_id: str) -> Optional[Dict[str, Any]]:
         row = cur.fetchone()
     return row_to_dict(row)
 
-def upsert_doc(conn: sqlite3.Connection, doc: Dict[str, Any]) -> None:
-    cols = list(doc.keys())
+# колонки docs, которые можно передавать в upsert_doc (имена подставляются в SQL — только реальные
+# колонки таблицы). Состав берём из PRAGMA table_info: docs дополняет ingest (sha256, src_path, mime...)
+_DOC_COLUMNS: Dict[str, frozenset] = {}
+
+def _doc_columns(conn: sqlite3.Connection, refresh: bool = False) -> frozenset:
+    path = db_file(conn)
+    cols = None if refresh else _DOC_COLUMNS.get(path)
+    if cols is None:
+        cols = frozenset(r[1] for r in conn.execute("PRAGMA table_info(docs)").fetchall())
+        if path:  # БД в памяти не кэшируем — путь у всех пустой
+            _DOC_COLUMNS[path] = cols
+    return cols
+
+@functools.lru_cache(maxsize=64)
+def _upsert_doc_sql(cols: tuple) -> str:
+    # один и тот же набор колонок -> одна и та же строка SQL (попадает в кэш выражений соединения)
     placeholders = ",".join(["?"] * len(cols))
     columns_csv = ",".join(cols)
     update_csv = ",".join([f"{c}=excluded.{c}" for c in cols if c != "doc_id"])
-    sql = f"""
+    conflict = f"DO UPDATE SET {update_csv}" if update_csv else "DO NOTHING"
+    return f"""
     INSERT INTO docs ({columns_csv}) VALUES ({placeholders})
-    ON CONFLICT(doc_id) DO UPDATE SET {update_csv}
+    ON CONFLICT(doc_id) {conflict}
     """
+
+def upsert_doc(conn: sqlite3.Connection, doc: Dict[str, Any]) -> None:
+    cols = tuple(doc.keys())
+    unknown = set(cols) - _doc_columns(conn)
+    if unknown:  # схема могла измениться после кэширования — перечитываем один раз
+        unknown = set(cols) - _doc_columns(conn, refresh=True)
+    if unknown:
+        raise ValueError(f"unknown docs columns: {', '.join(sorted(unknown))}")
     with get_cursor(conn) as cur:
-        cur.execute(sql, tuple(doc[c] for c in cols))
+        cur.execute(_upsert_doc_sql(cols), tuple(doc[c] for c in cols))
         conn.commit()
 
 def get_doc_entities(conn: sqlite3.Connection, doc_id: str) -> List[Dict[str, Any]]:
@@ -204,14 +330,22 @@ def get_active_rules_package(conn: sqlite3.Connection) -> Optional[Dict[str, Any
         row = cur.fetchone()
     return row_to_dict(row)
 
-def set_active_rules_package(conn: sqlite3.Connection, package: str, version: str) -> None:
+def set_active_rules_package(conn: sqlite3.Connection, package: str, version: str,
+                             commit: bool = True) -> None:
+    # commit=False — активация входит в транзакцию вызывающего (например, migrate)
+    # одно UPDATE и только по строкам, у которых флаг действительно меняется
     with get_cursor(conn) as cur:
-        cur.execute("UPDATE rules_meta SET active = 0 WHERE active = 1")
         cur.execute(
-            "UPDATE rules_meta SET active = 1 WHERE package = ? AND version = ?",
-            (package, version),
+            """
+            UPDATE rules_meta
+               SET active = CASE WHEN package = :p AND version = :v THEN 1 ELSE 0 END
+             WHERE (active = 1 AND NOT (package = :p AND version = :v))
+                OR (package = :p AND version = :v AND active IS NOT 1)
+            """,
+            {"p": package, "v": version},
         )
-        conn.commit()
+        if commit:
+            conn.commit()
 
 def list_rules_for_profile(conn: sqlite3.Connection, profile: str) -> List[Dict[str, Any]]:
     with get_cursor(conn) as cur:
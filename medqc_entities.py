@@ -3,54 +3,57 @@ import os
 import re
 import json
 import sqlite3
+import functools
 from datetime import datetime
 from typing import List, Dict, Tuple, Optional
 
+from medqc_db import CONN_PRAGMAS_SQL, db_file, json_dumps, json_loads
+from medqc_extract import TEXT_TABLES_SQL
+
 DB_PATH = os.getenv("MEDQC_DB", "/app/medqc.db")
 
 # ====== базовые утилиты ======
 def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+    # транзакции ведём вручную; WAL + synchronous=NORMAL — один fsync на пакет записей
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    conn.executescript(CONN_PRAGMAS_SQL)
     return conn
 
+ENTITIES_SCHEMA_SQL = TEXT_TABLES_SQL + """
+CREATE TABLE IF NOT EXISTS entities(
+  id          INTEGER PRIMARY KEY AUTOINCREMENT,
+  doc_id      TEXT NOT NULL,
+  etype       TEXT,
+  ts          TEXT,
+  span_start  INTEGER,
+  span_end    INTEGER,
+  value_json  TEXT,
+  source      TEXT,
+  confidence  REAL,
+  created_at  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events(
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  doc_id     TEXT NOT NULL,
+  kind       TEXT,
+  ts         TEXT,
+  payload    TEXT,
+  created_at TEXT NOT NULL
+);
+"""
+
+# вся схема — одним скриптом и один раз на файл БД в процессе
+_schema_ready: set = set()  # файлы БД, где схема уже создана
+
 def ensure_schema(conn: sqlite3.Connection):
-    conn.executescript("""
-    CREATE TABLE IF NOT EXISTS artifacts(
-      id         INTEGER PRIMARY KEY AUTOINCREMENT,
-      doc_id     TEXT NOT NULL,
-      kind       TEXT NOT NULL,
-      content    TEXT,
-      meta_json  TEXT,
-      created_at TEXT NOT NULL
-    );
-    CREATE TABLE IF NOT EXISTS raw(
-      doc_id     TEXT PRIMARY KEY,
-      content    TEXT,
-      created_at TEXT NOT NULL
-    );
-    CREATE TABLE IF NOT EXISTS entities(
-      id          INTEGER PRIMARY KEY AUTOINCREMENT,
-      doc_id      TEXT NOT NULL,
-      etype       TEXT,
-      ts          TEXT,
-      span_start  INTEGER,
-      span_end    INTEGER,
-      value_json  TEXT,
-      source      TEXT,
-      confidence  REAL,
-      created_at  TEXT NOT NULL
-    );
-    CREATE TABLE IF NOT EXISTS events(
-      id         INTEGER PRIMARY KEY AUTOINCREMENT,
-      doc_id     TEXT NOT NULL,
-      kind       TEXT,
-      ts         TEXT,
-      payload    TEXT,
-      created_at TEXT NOT NULL
-    );
-    """)
+    path = db_file(conn)
+    if path in _schema_ready:
+        return
+    conn.executescript(ENTITIES_SCHEMA_SQL)
     conn.commit()
+    if path:  # БД в памяти у каждого соединения своя — не запоминаем
+        _schema_ready.add(path)
 
 def read_full_text(conn: sqlite3.Connection, doc_id: str) -> str:
     r = conn.execute("SELECT content FROM raw WHERE doc_id=?", (doc_id,)).fetchone()
@@ -59,7 +62,7 @@ def read_full_text(conn: sqlite3.Connection, doc_id: str) -> str:
     a = conn.execute("SELECT content FROM artifacts WHERE doc_id=? AND kind='text_pages'", (doc_id,)).fetchone()
     if a and a["content"]:
         try:
-            pages = json.loads(a["content"])
+            pages = json_loads(a["content"])
             if isinstance(pages, list):
                 return "\n\n".join(pages)
             return str(a["content"])
@@ -67,6 +70,11 @@ def read_full_text(conn: sqlite3.Connection, doc_id: str) -> str:
             return str(a["content"])
     return ""
 
+_DATE_SEP_RE = re.compile(r"[/-]")
+_TIME_RE = re.compile(r"(\d{1,2}):(\d{2})")
+
+# одни и те же дата/время встречаются в документе многократно — кэшируем результат
+@functools.lru_cache(maxsize=4096)
 def to_iso(date_s: str, time_s: Optional[str]) -> Optional[str]:
     """
     Превращает строки вида '25.04.2025' и '14:05' в ISO.
@@ -76,7 +84,7 @@ def to_iso(date_s: str, time_s: Optional[str]) -> Optional[str]:
         return None
     date_s = date_s.strip()
     # нормализуем разделители
-    ds = re.sub(r"[/-]", ".", date_s)
+    ds = _DATE_SEP_RE.sub(".", date_s)
     parts = ds.split(".")
     if len(parts) < 3:
         return None
@@ -88,7 +96,7 @@ def to_iso(date_s: str, time_s: Optional[str]) -> Optional[str]:
     hh, mm = "00", "00"
     if time_s:
         tm = time_s.strip()
-        mobj = re.match(r"^(\d{1,2}):(\d{2})", tm)
+        mobj = _TIME_RE.match(tm)
         if mobj:
             hh = mobj.group(1).zfill(2)
             mm = mobj.group(2).zfill(2)
@@ -98,136 +106,184 @@ def to_iso(date_s: str, time_s: Optional[str]) -> Optional[str]:
     except Exception:
         return None
 
+def _as_json(obj) -> str:
+    # уже сериализованный payload не кодируем повторно
+    return obj if isinstance(obj, str) else json_dumps(obj)
+
+SQL_INSERT_EVENT = "INSERT INTO events(doc_id, kind, ts, payload, created_at) VALUES(?,?,?,?,datetime('now'))"
+SQL_INSERT_ENTITY = """INSERT INTO entities(doc_id, etype, ts, span_start, span_end, value_json, source, confidence, created_at)
+           VALUES(?,?,?,?,?,?,?, ?, datetime('now'))"""
+
+def event_row(doc_id: str, kind: str, ts: Optional[str], payload: dict) -> tuple:
+    return (doc_id, kind, ts, _as_json(payload))
+
+def entity_row(doc_id: str, etype: str, ts: Optional[str], span: Tuple[int,int], value: dict,
+               source="regex", confidence: float = 0.9) -> tuple:
+    s0, s1 = (span or (None, None))
+    return (doc_id, etype, ts, s0, s1, _as_json(value), source, float(confidence))
+
 def insert_event(conn: sqlite3.Connection, doc_id: str, kind: str, ts: Optional[str], payload: dict):
-    conn.execute(
-        "INSERT INTO events(doc_id, kind, ts, payload, created_at) VALUES(?,?,?,?,datetime('now'))",
-        (doc_id, kind, ts, json.dumps(payload, ensure_ascii=False))
-    )
+    conn.execute(SQL_INSERT_EVENT, event_row(doc_id, kind, ts, payload))
 
 def insert_entity(conn: sqlite3.Connection, doc_id: str, etype: str, ts: Optional[str],
                   span: Tuple[int,int], value: dict, source="regex", confidence: float = 0.9):
-    s0, s1 = (span or (None, None))
-    conn.execute(
-        """INSERT INTO entities(doc_id, etype, ts, span_start, span_end, value_json, source, confidence, created_at)
-           VALUES(?,?,?,?,?,?,?, ?, datetime('now'))""",
-        (doc_id, etype, ts, s0, s1, json.dumps(value, ensure_ascii=False), source, float(confidence))
-    )
+    conn.execute(SQL_INSERT_ENTITY, entity_row(doc_id, etype, ts, span, value, source, confidence))
 
 # ====== регэкспы и извлечение ======
 # Общая дата/время:  dd.mm.yyyy (г.)? hh:mm
 DT_RE = re.compile(
     r"(?P<date>\b\d{1,2}[./-]\d{1,2}[./-]\d{2,4})(?:\s*[гГ]\.?)?(?:\s+|[,;]\s*)(?P<time>\d{1,2}:\d{2})?",
-    flags=re.U | re.I
+    flags=re.I
+)
+
+# Ключевые фразы по видам — общие для extract_* и для однопроходного MASTER_RE
+ADMIT_RX = r"(поступл\w+|госпитал\w+|дата\s+поступл\w+)"
+DISCHARGE_RX = r"(выписан\w+|выбы\w+|дата\s+выписк\w+)"
+INITIAL_EXAM_RX = r"(первичн\w+\s+осмотр|осмотр\s+при\s+поступл\w+|осмотр\s+в\s+(при[ёе]мном|ПДО))"
+TRIAGE_RX = r"(триаж|сортиров\w+|ПДО|при[ёе]мн\w+\s+отделени\w+)"
+DAILY_NOTE_RX = r"(^|\n)\s*(?P<dn_date>\d{1,2}[./-]\d{1,2}[./-]\d{2,4})(?:\s*[гГ]\.?)?\s+(?P<dn_time>\d{1,2}:\d{2}).{0,40}?(жалоб|осмотр|состо[яи]н|температур|артериальн|сатурац)"
+ECG_RX = r"\bЭКГ\b"
+LAB_KEYS = [
+    (r"\bОАК\b|\bобщ(ий|его)\s+анализ\s+крови\b", "CBC"),
+    (r"\bбиохими\w+\b", "Biochem"),
+    (r"\bСРБ\b|\bCRP\b", "CRP"),
+    (r"\bкоагул\w+\b", "Coag")
+]
+DISCHARGE_SUMMARY_RX = r"(выписн\w+\s+эпикриз|эпикриз\s+выписн\w+)"
+MED_ORDER_RX = r"(лист\s+назначени\w+|назначено:|назначен[оы]\s+)"
+
+# группа -> (шаблон, таблица, kind/etype, окно до, окно после, лимит контекста, доп. payload, confidence);
+# порядок списка = порядок записи в БД (как при последовательном вызове extract_*)
+_PASSES = [
+    ("admit",        ADMIT_RX,        "event", "admit",        120, 120, 200, None, None),
+    ("discharge",    DISCHARGE_RX,    "event", "discharge",    120, 120, 200, None, None),
+    ("initial_exam", INITIAL_EXAM_RX, "event", "initial_exam", 120, 160, 200, None, None),
+    ("triage",       TRIAGE_RX,       "event", "triage",       120, 140, 200, None, None),
+    ("daily_note",   DAILY_NOTE_RX,   "event", "daily_note",   0,   300, None, None, None),
+    ("ecg",          ECG_RX,          "event", "ecg",          80,  120, 200, {"test": "ECG"}, None),
+] + [
+    (f"lab{i}", rx, "event", "lab", 80, 140, 200, {"test": name}, None)
+    for i, (rx, name) in enumerate(LAB_KEYS)
+] + [
+    ("discharge_summary", DISCHARGE_SUMMARY_RX, "entity", "discharge_summary", 120, 240, 300, None, 0.9),
+    ("med_order",         MED_ORDER_RX,         "entity", "med_order",         60,  300, 300, None, 0.8),
+]
+_PASS_BY_GROUP = {p[0]: p for p in _PASSES}
+# шаблоны отдельных видов компилируются один раз (re.U для str и так по умолчанию)
+_RE_BY_GROUP = {group: re.compile(rx, re.I) for group, rx, *_ in _PASSES}
+
+# Опережающая проверка первой буквы отсекает позиции до перебора альтернатив: первые буквы
+# ключевых фраз _PASSES (регистр не важен — re.I; "c" латинская — для CRP), \n и начало
+# текста — для daily_note. При добавлении шаблона — дополнить; tests/test_entities.py
+# проверяет набор и сверяет scan_all с отдельными проходами
+MASTER_FIRST_CHARS = "\ncбвгдклнопстэ"
+
+# Все виды — одной альтернацией: текст сканируется один раз, позиции-кандидаты находит
+# MASTER_RE, а виды, идущие в альтернации после сработавшего, scan_all проверяет в той же
+# позиции отдельно — совпадения разных видов в одной позиции не теряются
+MASTER_RE = re.compile(
+    "(?:(?=[" + MASTER_FIRST_CHARS + "])|^)(?:"
+    + "|".join(f"(?P<{group}>{rx})" for group, rx, *_ in _PASSES)
+    + ")",
+    flags=re.I
 )
+# для каждого вида — match-функции видов, стоящих в альтернации после него
+_LATER_MATCH = {
+    p[0]: [(q[0], _RE_BY_GROUP[q[0]].match) for q in _PASSES[i + 1:]]
+    for i, p in enumerate(_PASSES)
+}
 
 def find_first_dt(s: str) -> Optional[Tuple[str,str]]:
     m = DT_RE.search(s)
     if not m: return None
     return (m.group("date"), m.group("time"))
 
+def _hit(text: str, group: str, m: re.Match) -> Tuple[int,int,str,dict]:
+    """
+    Совпадение вида group -> (a, b, ts, payload): контекст вокруг и ближайшая дата/время в нём
+    """
+    _, _, _, _, before, after, limit, extra, _ = _PASS_BY_GROUP[group]
+    a, b = m.span()
+    if group == "daily_note":
+        # дата/время — в самой строке записи, контекст — от начала строки
+        ts = to_iso(m.group("dn_date"), m.group("dn_time"))
+        ctx = text[max(0,a):min(len(text), a+after)]
+        return (a, b, ts, {"context": ctx.strip()})
+    ctx = text[max(0,a-before):min(len(text), b+after)]
+    dt = find_first_dt(ctx)
+    ts = to_iso(dt[0], dt[1]) if dt else None
+    payload = dict(extra) if extra else {}
+    payload["context"] = ctx.strip()[:limit]
+    return (a, b, ts, payload)
+
+def _extract(text: str, group: str) -> List[Tuple[int,int,str,dict]]:
+    return [_hit(text, group, m) for m in _RE_BY_GROUP[group].finditer(text)]
+
 def extract_admit(text: str) -> List[Tuple[int,int,str,dict]]:
     """
     Поступление: ключевые фразы + ближайшая дата/время
     """
-    out = []
-    for m in re.finditer(r"(поступл\w+|госпитал\w+|дата\s+поступл\w+)", text, flags=re.I|re.U):
-        a, b = m.span()
-        ctx = text[max(0,a-120):min(len(text), b+120)]
-        dt = find_first_dt(ctx)
-        ts = to_iso(dt[0], dt[1]) if dt else None
-        out.append((a,b, ts, {"context": ctx.strip()[:200]}))
-    return out
+    return _extract(text, "admit")
 
 def extract_discharge(text: str) -> List[Tuple[int,int,str,dict]]:
-    out = []
-    for m in re.finditer(r"(выписан\w+|выбы\w+|дата\s+выписк\w+)", text, flags=re.I|re.U):
-        a,b = m.span()
-        ctx = text[max(0,a-120):min(len(text), b+120)]
-        dt = find_first_dt(ctx)
-        ts = to_iso(dt[0], dt[1]) if dt else None
-        out.append((a,b, ts, {"context": ctx.strip()[:200]}))
-    return out
+    return _extract(text, "discharge")
 
 def extract_initial_exam(text: str) -> List[Tuple[int,int,str,dict]]:
-    out = []
-    for m in re.finditer(r"(первичн\w+\s+осмотр|осмотр\s+при\s+поступл\w+|осмотр\s+в\s+(при[ёе]мном|ПДО))", text, flags=re.I|re.U):
-        a,b = m.span()
-        ctx = text[max(0,a-120):min(len(text), b+160)]
-        dt = find_first_dt(ctx)
-        ts = to_iso(dt[0], dt[1]) if dt else None
-        out.append((a,b, ts, {"context": ctx.strip()[:200]}))
-    return out
+    return _extract(text, "initial_exam")
 
 def extract_triage(text: str) -> List[Tuple[int,int,str,dict]]:
-    out = []
-    for m in re.finditer(r"(триаж|сортиров\w+|ПДО|при[ёе]мн\w+\s+отделени\w+)", text, flags=re.I|re.U):
-        a,b = m.span()
-        ctx = text[max(0,a-120):min(len(text), b+140)]
-        dt = find_first_dt(ctx)
-        ts = to_iso(dt[0], dt[1]) if dt else None
-        out.append((a,b, ts, {"context": ctx.strip()[:200]}))
-    return out
+    return _extract(text, "triage")
 
 def extract_daily_notes(text: str) -> List[Tuple[int,int,str,dict]]:
     """
     Ежедневные записи: строки, начинающиеся с ДД.ММ.ГГГГ( г.)? HH:MM и ключевых маркеров
     """
-    out = []
     # грубый поиск строк с датой/временем + слова состояния
-    for m in re.finditer(r"(^|\n)\s*(\d{1,2}[./-]\d{1,2}[./-]\d{2,4})(?:\s*[гГ]\.?)?\s+(\d{1,2}:\d{2}).{0,40}?(жалоб|осмотр|состо[яи]н|температур|артериальн|сатурац)", text, flags=re.I|re.U):
-        a,b = m.span()
-        date_s = m.group(2); time_s = m.group(3)
-        ts = to_iso(date_s, time_s)
-        ctx = text[max(0,a):min(len(text), a+300)]
-        out.append((a,b, ts, {"context": ctx.strip()}))
-    return out
+    return _extract(text, "daily_note")
 
 def extract_ecg(text: str) -> List[Tuple[int,int,str,dict]]:
-    out = []
-    for m in re.finditer(r"\bЭКГ\b", text, flags=re.I|re.U):
-        a,b = m.span()
-        ctx = text[max(0,a-80):min(len(text), b+120)]
-        dt = find_first_dt(ctx)
-        ts = to_iso(dt[0], dt[1]) if dt else None
-        payload = {"test":"ECG","context": ctx.strip()[:200]}
-        out.append((a,b, ts, payload))
-    return out
+    return _extract(text, "ecg")
 
 def extract_labs(text: str) -> List[Tuple[int,int,str,dict]]:
     out = []
-    lab_keys = [
-        (r"\bОАК\b|\bобщ(ий|его)\s+анализ\s+крови\b", "CBC"),
-        (r"\bбиохими\w+\b", "Biochem"),
-        (r"\bСРБ\b|\bCRP\b", "CRP"),
-        (r"\bкоагул\w+\b", "Coag")
-    ]
-    for rx, name in lab_keys:
-        for m in re.finditer(rx, text, flags=re.I|re.U):
-            a,b = m.span()
-            ctx = text[max(0,a-80):min(len(text), b+140)]
-            dt = find_first_dt(ctx)
-            ts = to_iso(dt[0], dt[1]) if dt else None
-            out.append((a,b, ts, {"test": name, "context": ctx.strip()[:200]}))
+    for i in range(len(LAB_KEYS)):
+        out.extend(_extract(text, f"lab{i}"))
     return out
 
 def extract_discharge_summary(text: str) -> List[Tuple[int,int,str,dict]]:
-    out = []
-    for m in re.finditer(r"(выписн\w+\s+эпикриз|эпикриз\s+выписн\w+)", text, flags=re.I|re.U):
-        a,b = m.span()
-        ctx = text[max(0,a-120):min(len(text), b+240)]
-        dt = find_first_dt(ctx)
-        ts = to_iso(dt[0], dt[1]) if dt else None
-        out.append((a,b, ts, {"context": ctx.strip()[:300]}))
-    return out
+    return _extract(text, "discharge_summary")
 
 def extract_med_order(text: str) -> List[Tuple[int,int,str,dict]]:
-    out = []
-    for m in re.finditer(r"(лист\s+назначени\w+|назначено:|назначен[оы]\s+)", text, flags=re.I|re.U):
-        a,b = m.span()
-        ctx = text[max(0,a-60):min(len(text), b+300)]
-        dt = find_first_dt(ctx)
-        ts = to_iso(dt[0], dt[1]) if dt else None
-        out.append((a,b, ts, {"context": ctx.strip()[:300]}))
+    return _extract(text, "med_order")
+
+def scan_all(text: str) -> Dict[str, List[Tuple[int,int,str,dict]]]:
+    """
+    Один проход MASTER_RE по тексту вместо отдельного finditer на каждый вид.
+    Возвращает совпадения по группам _PASSES — те же, что дали бы extract_*
+    (в пределах одного вида совпадения не перекрываются).
+    """
+    out = {p[0]: [] for p in _PASSES}
+    last_end: Dict[str, int] = {}
+    search = MASTER_RE.search
+    pos = 0
+    while True:
+        m = search(text, pos)
+        if m is None:
+            break
+        group = m.lastgroup
+        a, b = m.span(group)
+        pos = a + 1
+        if a >= last_end.get(group, 0):
+            last_end[group] = b
+            out[group].append(_hit(text, group, m))
+        # виды до group в этой позиции не совпали (иначе сработали бы они), проверяем только следующие
+        for other, match in _LATER_MATCH[group]:
+            if a < last_end.get(other, 0):
+                continue
+            m2 = match(text, a)
+            if m2 is not None:
+                last_end[other] = m2.end()
+                out[other].append(_hit(text, other, m2))
     return out
 
 # ====== основной процесс ======
@@ -240,40 +296,37 @@ def run_entities(doc_id: str) -> Dict[str, int]:
         conn.close()
         return {"doc_id": doc_id, "entities": 0, "events": 0}
 
-    inserted_e = inserted_ev = 0
-
-    # события
-    for a,b,ts,payload in extract_admit(full):
-        insert_event(conn, doc_id, "admit", ts, payload); inserted_ev += 1
-    for a,b,ts,payload in extract_discharge(full):
-        insert_event(conn, doc_id, "discharge", ts, payload); inserted_ev += 1
-    for a,b,ts,payload in extract_initial_exam(full):
-        insert_event(conn, doc_id, "initial_exam", ts, payload); inserted_ev += 1
-    for a,b,ts,payload in extract_triage(full):
-        insert_event(conn, doc_id, "triage", ts, payload); inserted_ev += 1
+    hits = scan_all(full)
+    ev_rows, ent_rows = [], []
+
     # daily_note — дедуп по дате
     seen_dates = set()
-    for a,b,ts,payload in extract_daily_notes(full):
-        if ts:
-            d = ts.split("T",1)[0]
-            if d in seen_dates:  # один daily_note на дату достаточно
+    for group, _, table, kind, *_, confidence in _PASSES:
+        for a,b,ts,payload in hits[group]:
+            if table == "entity":
+                ent_rows.append(entity_row(doc_id, kind, ts, (a,b), payload, source="regex", confidence=confidence))
                 continue
-            seen_dates.add(d)
-        insert_event(conn, doc_id, "daily_note", ts, payload); inserted_ev += 1
-    for a,b,ts,payload in extract_ecg(full):
-        insert_event(conn, doc_id, "ecg", ts, payload); inserted_ev += 1
-    for a,b,ts,payload in extract_labs(full):
-        insert_event(conn, doc_id, "lab", ts, payload); inserted_ev += 1
-
-    # сущности
-    for a,b,ts,payload in extract_discharge_summary(full):
-        insert_entity(conn, doc_id, "discharge_summary", ts, (a,b), payload, source="regex", confidence=0.9); inserted_e += 1
-    for a,b,ts,payload in extract_med_order(full):
-        insert_entity(conn, doc_id, "med_order", ts, (a,b), payload, source="regex", confidence=0.8); inserted_e += 1
+            if kind == "daily_note" and ts:
+                d = ts.split("T",1)[0]
+                if d in seen_dates:  # один daily_note на дату достаточно
+                    continue
+                seen_dates.add(d)
+            ev_rows.append(event_row(doc_id, kind, ts, payload))
 
-    conn.commit()
-    conn.close()
-    return {"doc_id": doc_id, "entities": inserted_e, "events": inserted_ev}
+    # все вставки — одной транзакцией
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(SQL_INSERT_EVENT, ev_rows)
+        conn.executemany(SQL_INSERT_ENTITY, ent_rows)
+        conn.execute("COMMIT")
+    except Exception:
+        # если не удался сам BEGIN (БД занята) — откатывать нечего, пробрасываем исходную ошибку
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return {"doc_id": doc_id, "entities": len(ent_rows), "events": len(ev_rows)}
 
 def main():
     import argparse
@@ -2,34 +2,65 @@ import os
 import json
 import sqlite3
 
+from medqc_db import CONN_PRAGMAS_SQL, db_file, json_dumps
+
+# общие таблицы текста (используются и в medqc_entities)
+TEXT_TABLES_SQL = """
+CREATE TABLE IF NOT EXISTS artifacts(
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  doc_id     TEXT NOT NULL,
+  kind       TEXT NOT NULL,
+  content    TEXT,
+  meta_json  TEXT,
+  created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_artifacts_doc_kind ON artifacts(doc_id, kind);
+CREATE TABLE IF NOT EXISTS raw(
+  doc_id     TEXT PRIMARY KEY,
+  content    TEXT,
+  created_at TEXT NOT NULL
+);
+"""
+
+def get_conn() -> sqlite3.Connection:
+    # WAL + synchronous=NORMAL: запись страниц/текста не ждёт полного fsync на каждый коммит
+    con = sqlite3.connect(os.getenv("MEDQC_DB", "/app/medqc.db"))
+    con.row_factory = sqlite3.Row
+    con.executescript(CONN_PRAGMAS_SQL)
+    return con
+
+# у artifacts нет уникального ключа (doc_id, kind) — OR REPLACE не срабатывал и копились дубли,
+# поэтому прежний text_pages удаляется явно перед вставкой
+SQL_DELETE_TEXT_PAGES = "DELETE FROM artifacts WHERE doc_id=? AND kind='text_pages'"
+SQL_INSERT_TEXT_PAGES = """
+    INSERT INTO artifacts(doc_id, kind, content, meta_json, created_at)
+    VALUES(?, 'text_pages', ?, ?, datetime('now'))
+"""
+SQL_UPSERT_RAW = """
+    INSERT OR REPLACE INTO raw(doc_id, content, created_at)
+    VALUES(?, ?, datetime('now'))
+"""
+
+# схема создаётся один раз на файл БД в процессе
+_text_tables_ready: set = set()  # файлы БД, где схема уже создана
+
 def ensure_text_tables(conn: sqlite3.Connection):
-    conn.executescript("""
-    CREATE TABLE IF NOT EXISTS artifacts(
-      id         INTEGER PRIMARY KEY AUTOINCREMENT,
-      doc_id     TEXT NOT NULL,
-      kind       TEXT NOT NULL,
-      content    TEXT,
-      meta_json  TEXT,
-      created_at TEXT NOT NULL
-    );
-    CREATE TABLE IF NOT EXISTS raw(
-      doc_id     TEXT PRIMARY KEY,
-      content    TEXT,
-      created_at TEXT NOT NULL
-    );
-    """)
+    path = db_file(conn)
+    if path in _text_tables_ready:
+        return
+    conn.executescript(TEXT_TABLES_SQL)
     conn.commit()
+    if path:  # БД в памяти у каждого соединения своя — не запоминаем
+        _text_tables_ready.add(path)
 
 def extract_pdf_text(path):
     try:
         import fitz  # PyMuPDF
     except Exception:
         raise RuntimeError("PyMuPDF (pymupdf) не установлен в контейнере.")
-    doc = fitz.open(path)
-    pages = []
-    for p in doc:
-        pages.append(p.get_text("text"))
-    return pages, "pdf"
+    # документ закрываем сразу после разбора — не ждём сборщика мусора
+    with fitz.open(path) as doc:
+        return [p.get_text("text") for p in doc], "pdf"
 
 def extract_docx_paragraphs(path):
     try:
@@ -37,59 +68,63 @@ def extract_docx_paragraphs(path):
     except Exception:
         raise RuntimeError("python-docx не установлен в окружении контейнера.")
     d = docx.Document(path)
-    buf, pages = "", []
+    # абзацы копим списком и склеиваем один раз на страницу (без квадратичного buf +=)
+    chunks, buf_len, pages = [], 0, []
     for p in d.paragraphs:
         t = (p.text or "").strip()
         if not t:
             continue
-        if len(buf) + len(t) > 1500:
-            pages.append(buf)
-            buf = t + "\n"
+        if buf_len + len(t) > 1500:
+            pages.append("".join(chunks))
+            chunks, buf_len = [t, "\n"], len(t) + 1
         else:
-            buf += t + "\n"
-    if buf:
-        pages.append(buf)
+            chunks += (t, "\n")
+            buf_len += len(t) + 1
+    if chunks:
+        pages.append("".join(chunks))
     return pages, "docx"
 
 def run_extract(doc_id: str):
-    db = os.getenv("MEDQC_DB", "/app/medqc.db")
-    con = sqlite3.connect(db); con.row_factory = sqlite3.Row
-    ensure_text_tables(con)
+    con = get_conn()
+    try:
+        ensure_text_tables(con)
 
-    row = con.execute("SELECT path, filename FROM docs WHERE doc_id=?", (doc_id,)).fetchone()
-    if not row:
-        raise RuntimeError(f"doc_id={doc_id} не найден в docs.")
-    src = row["path"]
-    if not src or not os.path.exists(src):
-        raise RuntimeError(f"Файл для doc_id={doc_id} не найден: {src}")
+        row = con.execute("SELECT path FROM docs WHERE doc_id=?", (doc_id,)).fetchone()
+        if not row:
+            raise RuntimeError(f"doc_id={doc_id} не найден в docs.")
+        src = row["path"]
+        if not src or not os.path.exists(src):
+            raise RuntimeError(f"Файл для doc_id={doc_id} не найден: {src}")
 
-    ext = (os.path.splitext(src)[1] or "").lower()
-    if ext == ".pdf":
-        pages, producer = extract_pdf_text(src)
-    elif ext == ".docx":
-        pages, producer = extract_docx_paragraphs(src)
-    else:
-        if src.lower().endswith(".doc"):
-            raise RuntimeError("Файл .doc не поддерживается. Конвертируйте в .docx.")
-        try:
+        ext = (os.path.splitext(src)[1] or "").lower()
+        if ext == ".pdf":
             pages, producer = extract_pdf_text(src)
-        except Exception:
+        elif ext == ".docx":
             pages, producer = extract_docx_paragraphs(src)
+        else:
+            if src.lower().endswith(".doc"):
+                raise RuntimeError("Файл .doc не поддерживается. Конвертируйте в .docx.")
+            try:
+                pages, producer = extract_pdf_text(src)
+            except Exception:
+                pages, producer = extract_docx_paragraphs(src)
 
-    # пишем pages в artifacts
-    con.execute("""
-        INSERT OR REPLACE INTO artifacts(doc_id, kind, content, meta_json, created_at)
-        VALUES(?, 'text_pages', ?, ?, datetime('now'))
-    """, (doc_id, json.dumps(pages, ensure_ascii=False), json.dumps({"producer": producer}, ensure_ascii=False)))
-
-    # и обязательно склеенный текст в raw — для старых зависимостей
-    full_text = "\n\n".join(pages)
-    con.execute("""
-        INSERT OR REPLACE INTO raw(doc_id, content, created_at)
-        VALUES(?, ?, datetime('now'))
-    """, (doc_id, full_text))
+        # обе записи — одной транзакцией (разбор файла уже позади, блокировка короткая)
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            # пишем pages в artifacts
+            con.execute(SQL_DELETE_TEXT_PAGES, (doc_id,))
+            con.execute(SQL_INSERT_TEXT_PAGES, (doc_id, json_dumps(pages), json_dumps({"producer": producer})))
 
-    con.commit(); con.close()
+            # и обязательно склеенный текст в raw — для старых зависимостей
+            full_text = "\n\n".join(pages)
+            con.execute(SQL_UPSERT_RAW, (doc_id, full_text))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    finally:
+        con.close()
     return {"doc_id": doc_id, "pages": len(pages), "producer": producer}
 
 def main():
@@ -2,22 +2,46 @@
 # -*- coding: utf-8 -*-
 
 import os
+import mmap
 import shutil
 import hashlib
 import argparse
 import mimetypes
 import json
 import sqlite3
-from datetime import datetime
-from pathlib import Path
 
-from medqc_db import DB_PATH, UPLOADS_DIR, get_conn, ensure_docs_schema
+from medqc_db import UPLOADS_DIR, get_conn, ensure_docs_schema
+
+MMAP_HASH_MIN = 16 << 20  # крупные файлы (сканы PDF) хэшируем через mmap — без копий в буферы Python
 
 def sha256_of(path: str) -> str:
+    # без буфера Python: file_digest/readinto читают прямо в свои буферы, без лишней копии
+    with open(path, "rb", buffering=0) as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_HASH_MIN:  # пустой файл mmap не умеет — порог это исключает
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):  # читаем строго подряд — пусть ядро читает вперёд
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                return hashlib.sha256(mm).hexdigest()
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+: весь цикл чтения внутри C
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
+        buf = memoryview(bytearray(4 << 20))
+        for n in iter(lambda: f.readinto(buf), 0):
+            h.update(buf[:n])
+    return h.hexdigest()
+
+def _copy_and_hash(src: str, dst: str) -> str:
+    """
+    Копирует src -> dst и одновременно считает sha256: файл читается один раз, а не дважды.
+    """
     h = hashlib.sha256()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+    buf = memoryview(bytearray(1 << 20))
+    with open(src, "rb", buffering=0) as fi, open(dst, "wb") as fo:
+        for n in iter(lambda: fi.readinto(buf), 0):
+            chunk = buf[:n]
             h.update(chunk)
+            fo.write(chunk)
+    shutil.copystat(src, dst)  # как shutil.copy2: mtime и права
     return h.hexdigest()
 
 def safe_mime(path: str) -> str:
@@ -29,44 +53,44 @@ def ensure_upload_dest(doc_id: str) -> str:
     os.makedirs(dest_dir, exist_ok=True)
     return dest_dir
 
+SQL_UPSERT_DOC = """
+    INSERT INTO docs(doc_id, sha256, src_path, mime, size, facility, dept, author, admit_dt, created_at, filename, path, department)
+    VALUES(?,?,?,?,?,?,?,?,'',strftime('%Y-%m-%dT%H:%M:%SZ','now'), ?, ?, '')
+    ON CONFLICT(doc_id) DO UPDATE
+       SET sha256=excluded.sha256,
+           src_path=excluded.src_path,
+           mime=excluded.mime,
+           size=excluded.size,
+           filename=excluded.filename,
+           path=excluded.path,
+           facility=COALESCE(docs.facility,''),
+           dept=COALESCE(docs.dept,''),
+           author=COALESCE(docs.author,'')"""
+
 def upsert_doc(conn: sqlite3.Connection, doc_id: str, src_abs: str, filename: str, mime: str, size: int,
-               facility: str = "", dept: str = "", author: str = ""):
+               facility: str = "", dept: str = "", author: str = "", sha: str = None):
     """
     Гарантированно пишет запись в docs. Предполагает, что ensure_docs_schema(conn) уже вызван.
+    sha — уже посчитанный хэш файла (если нет, считается здесь).
     """
-    sha = sha256_of(src_abs)
-    created_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-
-    row = conn.execute("SELECT doc_id FROM docs WHERE doc_id=?", (doc_id,)).fetchone()
-    if row:
-        conn.execute("""
-            UPDATE docs
-               SET sha256=?,
-                   src_path=?,
-                   mime=?,
-                   size=?,
-                   filename=?,
-                   path=?,
-                   facility=COALESCE(facility,''),
-                   dept=COALESCE(dept,''),
-                   author=COALESCE(author,'')
-             WHERE doc_id=?""",
-             (sha, src_abs, mime, size, filename, src_abs, doc_id))
-    else:
-        conn.execute("""
-            INSERT INTO docs(doc_id, sha256, src_path, mime, size, facility, dept, author, admit_dt, created_at, filename, path, department)
-            VALUES(?,?,?,?,?,?,?,?,'',?, ?, ?, '')""",
-            (doc_id, sha, src_abs, mime, size, facility, dept, author, created_at, filename, src_abs)
-        )
+    sha = sha or sha256_of(src_abs)
+
+    # одна инструкция вместо SELECT + UPDATE/INSERT; при конфликте created_at/admit_dt/department
+    # не трогаем, а facility/dept/author только доводим до '' (как и прежняя ветка UPDATE).
+    # created_at ставит сам SQLite и только в ветке INSERT — при обновлении он не вычисляется
+    conn.execute(SQL_UPSERT_DOC, (doc_id, sha, src_abs, mime, size, facility, dept, author, filename, src_abs))
 
 def ingest_file(src_file: str, doc_id: str, facility: str = "", dept: str = "", author: str = "") -> dict:
-    if not os.path.exists(src_file):
-        raise FileNotFoundError(f"File not found: {src_file}")
+    # один stat: и проверка существования, и размер
+    try:
+        st = os.stat(src_file)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"File not found: {src_file}") from None
 
     src_abs = os.path.abspath(src_file)
     filename = os.path.basename(src_abs)
     mime = safe_mime(src_abs)
-    size = os.path.getsize(src_abs)
+    size = st.st_size
 
     with get_conn() as conn:
         # гарантируем наличие таблицы docs
@@ -75,11 +99,12 @@ def ingest_file(src_file: str, doc_id: str, facility: str = "", dept: str = "",
         # переносим в /app/uploads/<doc_id>/<filename>
         dest_dir = ensure_upload_dest(doc_id)
         dest_file = os.path.join(dest_dir, filename)
+        sha = None
         if src_abs != dest_file:
-            shutil.copy2(src_abs, dest_file)
+            sha = _copy_and_hash(src_abs, dest_file)
 
         # обновляем запись в docs (src_path/path указывают на dest_file)
-        upsert_doc(conn, doc_id, dest_file, filename, mime, size, facility, dept, author)
+        upsert_doc(conn, doc_id, dest_file, filename, mime, size, facility, dept, author, sha=sha)
         conn.commit()
 
     return {
@@ -1,22 +1,87 @@
 # medqc_norms_admin.py
 # Импорт правил из rules.json и активация пакета
 
-import json
+import os
 from typing import Any, Dict, List, Tuple
 import sqlite3
 
-from medqc_db import get_cursor, row_to_dict, set_active_rules_package
+from medqc_db import get_cursor, json_dumps, json_loads, set_active_rules_package
 
-def _json(obj: Any) -> str:
-    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+SQL_UPSERT_RULES_META = """
+INSERT INTO rules_meta (package, version, title, description, active)
+VALUES (?, ?, ?, ?, 0)
+ON CONFLICT(package, version) DO UPDATE SET
+  title=excluded.title,
+  description=excluded.description
+WHERE title IS NOT excluded.title OR description IS NOT excluded.description
+"""
+
+SQL_UPSERT_RULE = """
+INSERT INTO rules (
+  rule_id, package, version, title, profile, severity, enabled,
+  params_json, sources_json, effective_from, effective_to, notes
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(rule_id, package, version) DO UPDATE SET
+  title=excluded.title,
+  profile=excluded.profile,
+  severity=excluded.severity,
+  enabled=excluded.enabled,
+  params_json=excluded.params_json,
+  sources_json=excluded.sources_json,
+  effective_from=excluded.effective_from,
+  effective_to=excluded.effective_to,
+  notes=excluded.notes
+-- повторный импорт того же rules.json не переписывает неизменившиеся строки
+WHERE title IS NOT excluded.title
+   OR profile IS NOT excluded.profile
+   OR severity IS NOT excluded.severity
+   OR enabled IS NOT excluded.enabled
+   OR params_json IS NOT excluded.params_json
+   OR sources_json IS NOT excluded.sources_json
+   OR effective_from IS NOT excluded.effective_from
+   OR effective_to IS NOT excluded.effective_to
+   OR notes IS NOT excluded.notes
+"""
+
+# При крупном импорте неуникальные индексы rules дешевле снять и построить заново одной
+# сортировкой, чем обновлять на каждой вставке. DDL берётся из sqlite_master — определения
+# остаются только в medqc_db.SCHEMA_SQL. Уникальные индексы (на них держится ON CONFLICT)
+# не трогаем
+def _secondary_indexes(cur: sqlite3.Cursor, table: str) -> List[Tuple[str, str]]:
+    names = [
+        row[1] for row in cur.execute(f"PRAGMA index_list({table})").fetchall()
+        if not row[2] and row[3] == "c"  # unique=0, создан через CREATE INDEX
+    ]
+    if not names:
+        return []
+    return cur.execute(
+        f"SELECT name, sql FROM sqlite_master WHERE type='index' AND name IN ({','.join('?' * len(names))})",
+        names,
+    ).fetchall()
+
+# с какого числа правил в файле откладывать индексы (пересборка сканирует всю таблицу)
+DEFER_INDEX_MIN_RULES = int(os.getenv("MEDQC_DEFER_INDEX_MIN_RULES", "5000"))
+
+# разобранный rules.json по пути; ключ актуальности — (mtime_ns, size) файла
+_RULES_CACHE: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+
+def _load_rules_file(rules_path: str) -> Dict[str, Any]:
+    st = os.stat(rules_path)
+    key = (st.st_mtime_ns, st.st_size)
+    hit = _RULES_CACHE.get(rules_path)
+    if hit and hit[0] == key:
+        return hit[1]
+    with open(rules_path, "rb") as f:
+        data = json_loads(f.read())
+    _RULES_CACHE[rules_path] = (key, data)
+    return data
 
 def migrate(conn: sqlite3.Connection, rules_path: str) -> Dict[str, Any]:
     """
     Импортирует правила из rules.json в таблицы rules_meta и rules.
     Активирует импортированный пакет.
     """
-    with open(rules_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = _load_rules_file(rules_path)
 
     package = data.get("package")
     version = data.get("version")
@@ -27,83 +92,62 @@ def migrate(conn: sqlite3.Connection, rules_path: str) -> Dict[str, Any]:
     if not package or not version:
         raise ValueError("rules.json must contain 'package' and 'version'")
 
-    # upsert в rules_meta
-    with get_cursor(conn) as cur:
-        cur.execute(
-            """
-            INSERT INTO rules_meta (package, version, title, description, active)
-            VALUES (?, ?, ?, ?, 0)
-            ON CONFLICT(package, version) DO UPDATE SET
-              title=excluded.title,
-              description=excluded.description
-            """,
-            (package, version, title, description),
-        )
-        conn.commit()
+    # пакет, правила и активация — одной транзакцией: один коммит, и при ошибке ничего не меняется
+    try:
+        # upsert в rules_meta
+        with get_cursor(conn) as cur:
+            cur.execute(SQL_UPSERT_RULES_META, (package, version, title, description))
 
-    # вставка/обновление правил
-    inserted = 0
-    updated = 0
-    with get_cursor(conn) as cur:
-        for r in rules_list:
-            rule_id = r.get("id") or r.get("rule_id")
-            if not rule_id:
-                continue
-            params_json = _json(r.get("params") or {})
-            sources_json = _json(r.get("sources") or [])
-
-            try:
-                cur.execute(
-                    """
-                    INSERT INTO rules (
-                      rule_id, package, version, title, profile, severity, enabled,
-                      params_json, sources_json, effective_from, effective_to, notes
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (
-                        rule_id,
-                        package,
-                        version,
-                        r.get("title"),
-                        r.get("profile"),
-                        r.get("severity"),
-                        1 if r.get("enabled", True) else 0,
-                        params_json,
-                        sources_json,
-                        r.get("effective_from"),
-                        r.get("effective_to"),
-                        r.get("notes"),
-                    ),
-                )
-                inserted += 1
-            except sqlite3.IntegrityError:
-                cur.execute(
-                    """
-                    UPDATE rules
-                    SET title=?, profile=?, severity=?, enabled=?,
-                        params_json=?, sources_json=?, effective_from=?, effective_to=?, notes=?
-                    WHERE rule_id=? AND package=? AND version=?
-                    """,
-                    (
-                        r.get("title"),
-                        r.get("profile"),
-                        r.get("severity"),
-                        1 if r.get("enabled", True) else 0,
-                        params_json,
-                        sources_json,
-                        r.get("effective_from"),
-                        r.get("effective_to"),
-                        r.get("notes"),
-                        rule_id,
-                        package,
-                        version,
-                    ),
+        # вставка/обновление правил: один UPSERT через executemany.
+        # Счётчики inserted/updated — по уже существующим rule_id пакета (и повторам внутри файла)
+        inserted = 0
+        updated = 0
+        with get_cursor(conn) as cur:
+            existing = {
+                row[0] for row in cur.execute(
+                    "SELECT rule_id FROM rules WHERE package=? AND version=?", (package, version)
                 )
-                updated += 1
-        conn.commit()
+            }
+            rows = []
+            for r in rules_list:
+                rule_id = r.get("id") or r.get("rule_id")
+                if not rule_id:
+                    continue
+                if rule_id in existing:
+                    updated += 1
+                else:
+                    existing.add(rule_id)
+                    inserted += 1
+                rows.append((
+                    rule_id,
+                    package,
+                    version,
+                    r.get("title"),
+                    r.get("profile"),
+                    r.get("severity"),
+                    1 if r.get("enabled", True) else 0,
+                    json_dumps(r.get("params") or {}),
+                    json_dumps(r.get("sources") or []),
+                    r.get("effective_from"),
+                    r.get("effective_to"),
+                    r.get("notes"),
+                ))
 
-    # активируем пакет
-    set_active_rules_package(conn, package, version)
+            deferred = _secondary_indexes(cur, "rules") if len(rows) >= DEFER_INDEX_MIN_RULES else []
+            for name, _ in deferred:
+                cur.execute('DROP INDEX "%s"' % name.replace('"', '""'))
+            cur.executemany(SQL_UPSERT_RULE, rows)
+            for _, ddl in deferred:
+                cur.execute(ddl)
+
+        # активируем пакет
+        set_active_rules_package(conn, package, version, commit=False)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # после массовой записи обновляем статистику планировщика (дёшево: только где нужно)
+    conn.execute("PRAGMA optimize")
 
     return {
         "package": package,
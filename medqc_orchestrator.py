@@ -1,4 +1,5 @@
 import os
+import json
 import subprocess
 
 MEDQC_DB = os.getenv("MEDQC_DB", "/app/medqc.db")
@@ -36,7 +37,6 @@ def run_rules_only(doc_id: str, package: str = DEFAULT_RULES_PACKAGE, version: s
     cp = subprocess.run(cmd, check=True, env=env, capture_output=True, text=True)
     out = (cp.stdout or "").strip()
     if out.startswith("{") or out.startswith("["):
-        import json
         try:
             return json.loads(out)
         except Exception:
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import json
 import argparse
 import sqlite3
@@ -60,7 +61,6 @@ def mask_text(s: Optional[str]) -> Optional[str]:
     if not s:
         return s
     # очень простая маскировка: заменим 8+ подряд идущих букв/цифр на ***
-    import re
     return re.sub(r"([A-Za-zА-Яа-яЁё0-9]{8,})", "***", s)
 
 def build_json_report(doc_id: str, package_name: str, package_version: str, do_mask: bool) -> Dict[str, Any]:
@@ -163,6 +163,11 @@ def main():
     payload = build_json_report(args.doc_id, args.package_name, args.package_version, args.mask)
 
     if args.format == "json":
+        if args.out:
+            # пишем прямо в файл, без промежуточной строки на весь отчёт
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False, indent=2)
+            return
         out = json.dumps(payload, ensure_ascii=False, indent=2)
     elif args.format == "html":
         out = build_html_report(payload)
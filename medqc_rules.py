@@ -1,10 +1,12 @@
 import os
-import re
 import json
 import sqlite3
+import functools
 from datetime import datetime, timedelta
 from typing import List
 
+from medqc_db import json_dumps, json_loads
+
 # ====== НОРМАЛИЗАЦИЯ РУССКИХ СИНОНИМОВ ======
 RU_EVENT_SYNONYMS = {
     "admit":       ["admit","поступ","госпитал"],
@@ -24,6 +26,8 @@ RU_ENTITY_SYNONYMS = {
     "symptom":           ["symptom","симптом"]
 }
 
+# различных kind/etype в базе единицы, а вызовов — по одному на каждое событие/сущность
+@functools.lru_cache(maxsize=256)
 def _normalize_kind(kind: str) -> str:
     k = (kind or "").lower()
     for canon, syns in RU_EVENT_SYNONYMS.items():
@@ -31,6 +35,7 @@ def _normalize_kind(kind: str) -> str:
             return canon
     return k
 
+@functools.lru_cache(maxsize=256)
 def _normalize_etype(etype: str) -> str:
     t = (etype or "").lower()
     for canon, syns in RU_ENTITY_SYNONYMS.items():
@@ -39,6 +44,8 @@ def _normalize_etype(etype: str) -> str:
     return t
 
 # ====== УТИЛИТЫ ======
+# каждое правило заново разбирает ts всех событий — кэшируем разбор строки
+@functools.lru_cache(maxsize=4096)
 def parse_iso_any(s: str):
     if not s: return None
     try:
@@ -61,7 +68,7 @@ def get_entities(conn: sqlite3.Connection, doc_id: str):
     for r in rows:
         d = dict(r)
         try:
-            d["value"] = json.loads(d.get("value_json") or "{}")
+            d["value"] = json_loads(d.get("value_json") or "{}")
         except Exception:
             d["value"] = {}
         d["etype"] = _normalize_etype(d.get("etype",""))
@@ -106,12 +113,13 @@ def infer_profiles(doc_row, entities, events):
 
 def load_active_rules(conn: sqlite3.Connection, profiles: List[str],
                       package_name: str = None, package_version: str = None):
+    # только колонки, которые читает run_rules (notes/sources_json и пр. не тянем)
     conn.row_factory = sqlite3.Row
     prof_in = ",".join(["?"] * len(profiles)) if profiles else "?"
     params = list(profiles or ["STA"])
     if package_name and package_version:
         sql = f"""
-        SELECT r.*
+        SELECT r.rule_id, r.profile, r.severity, r.params_json
         FROM norm_rules r
         WHERE r.enabled=1
           AND r.profile IN ({prof_in})
@@ -125,7 +133,7 @@ def load_active_rules(conn: sqlite3.Connection, profiles: List[str],
         rows = conn.execute(sql, params).fetchall()
     else:
         sql = f"""
-        SELECT r.*
+        SELECT r.rule_id, r.profile, r.severity, r.params_json
         FROM norm_rules r
         JOIN norm_packages p ON (p.pkg_id=r.pkg_id)
         WHERE r.enabled=1 AND p.active=1 AND r.profile IN ({prof_in})
@@ -134,23 +142,33 @@ def load_active_rules(conn: sqlite3.Connection, profiles: List[str],
         rows = conn.execute(sql, params).fetchall()
     return [dict(r) for r in rows]
 
+SQL_INSERT_VIOLATION = """INSERT INTO violations(doc_id, rule_id, severity, message, evidence_json, sources_json, created_at)
+           VALUES(?,?,?,?,?, ?, datetime('now'))"""
+SQL_INSERT_RULE_RESULT = """INSERT INTO rule_results(doc_id, rule_id, profile, severity, passed, message, created_at)
+           VALUES(?,?,?,?,?, ?, datetime('now'))"""
+
+def violation_row(doc_id: str, rule_id: str, sev: str, message: str,
+                  sources=None, evidence=None) -> tuple:
+    # sources/evidence можно передать уже сериализованными — тогда dumps не повторяется
+    if not evidence:
+        evidence = "{}"
+    elif not isinstance(evidence, str):
+        evidence = json_dumps(evidence)
+    if not isinstance(sources, str):
+        sources = json_dumps(sources or [])
+    return (doc_id, rule_id, sev, message, evidence, sources)
+
+def rule_result_row(doc_id: str, rule_id: str, profile: str, severity: str,
+                    passed: int, message: str) -> tuple:
+    return (doc_id, rule_id, profile or "", severity or "", int(bool(passed)), message or "")
+
 def insert_violation(conn: sqlite3.Connection, doc_id: str, rule_id: str,
                      sev: str, message: str, sources: list = None, evidence: dict = None):
-    conn.execute(
-        """INSERT INTO violations(doc_id, rule_id, severity, message, evidence_json, sources_json, created_at)
-           VALUES(?,?,?,?,?, ?, datetime('now'))""",
-        (doc_id, rule_id, sev, message,
-         json.dumps(evidence or {}, ensure_ascii=False),
-         json.dumps(sources or [], ensure_ascii=False))
-    )
+    conn.execute(SQL_INSERT_VIOLATION, violation_row(doc_id, rule_id, sev, message, sources, evidence))
 
 def insert_rule_result(conn: sqlite3.Connection, doc_id: str, rule_id: str,
                        profile: str, severity: str, passed: int, message: str):
-    conn.execute(
-        """INSERT INTO rule_results(doc_id, rule_id, profile, severity, passed, message, created_at)
-           VALUES(?,?,?,?,?, ?, datetime('now'))""",
-        (doc_id, rule_id, profile or "", severity or "", int(bool(passed)), message or "")
-    )
+    conn.execute(SQL_INSERT_RULE_RESULT, rule_result_row(doc_id, rule_id, profile, severity, passed, message))
 
 # ====== Реализации нескольких базовых правил ======
 def rule_STA_001(doc, sections, entities, events, params):
@@ -242,8 +260,8 @@ def run_rules(doc_id: str, package_name: str = None, package_version: str = None
     db = os.getenv("MEDQC_DB", "/app/medqc.db")
     conn = sqlite3.connect(db); conn.row_factory = sqlite3.Row
 
-    # гарантируем наличие rule_results
-    conn.execute("""
+    # гарантируем наличие rule_results (индекс по doc_id — для очистки прошлых результатов без полного скана)
+    conn.executescript("""
     CREATE TABLE IF NOT EXISTS rule_results(
       id         INTEGER PRIMARY KEY AUTOINCREMENT,
       doc_id     TEXT NOT NULL,
@@ -254,18 +272,21 @@ def run_rules(doc_id: str, package_name: str = None, package_version: str = None
       message    TEXT,
       created_at TEXT NOT NULL
     );
+    CREATE INDEX IF NOT EXISTS idx_rule_results_doc ON rule_results(doc_id);
     """)
 
-    doc = get_doc(conn, doc_id)
-    if not doc:
+    row = get_doc(conn, doc_id)
+    if not row:
         conn.close()
         return {"error": {"code": "DOC_NOT_FOUND", "message": f"doc_id={doc_id}"}}
+    # строка docs материализуется один раз и переиспользуется всеми правилами
+    doc = dict(row)
 
     sections = get_sections(conn, doc_id)
     entities = get_entities(conn, doc_id)
     events   = get_events(conn, doc_id)
 
-    profiles = infer_profiles(dict(doc), entities, events)
+    profiles = infer_profiles(doc, entities, events)
     rules = load_active_rules(conn, profiles, package_name, package_version)
 
     # очищаем прошлые результаты
@@ -273,19 +294,22 @@ def run_rules(doc_id: str, package_name: str = None, package_version: str = None
 
     total = 0
     failed = 0
+    # строки копим в списках и пишем одним executemany на таблицу
+    viol_rows, result_rows = [], []
     for r in rules:
         rid = r.get("rule_id")
         profile = r.get("profile") or ""
         severity = r.get("severity") or "minor"
         impl = RULE_IMPL.get(rid)
-        try:
-            params = json.loads(r.get("params_json") or "{}")
-        except Exception:
-            params = {}
 
         if impl:
+            # params разбираем только для правил с реализацией — остальным они не нужны
+            try:
+                params = json_loads(r.get("params_json") or "{}")
+            except Exception:
+                params = {}
             try:
-                vlist = impl(dict(doc), sections, entities, events, params)
+                vlist = impl(doc, sections, entities, events, params)
             except Exception as ex:
                 vlist = [ (rid, str(severity), f"Ошибка исполнения правила: {ex}") ]
         else:
@@ -296,17 +320,20 @@ def run_rules(doc_id: str, package_name: str = None, package_version: str = None
             # есть нарушения → записываем violation’ы и rule_result(passed=0)
             failed += 1
             first_msg = None
+            sources_json = json_dumps([{"rule_id": rid}])  # один раз на правило
             for (rule_id, sev, message) in vlist:
                 if first_msg is None:
                     first_msg = message
-                insert_violation(conn, doc_id, rule_id, sev, message, sources=[{"rule_id": rid}])
-            insert_rule_result(conn, doc_id, rid, profile, severity, 0, first_msg or "Нарушение")
+                viol_rows.append(violation_row(doc_id, rule_id, sev, message, sources=sources_json))
+            result_rows.append(rule_result_row(doc_id, rid, profile, severity, 0, first_msg or "Нарушение"))
         else:
             # нарушений нет → rule_result(passed=1)
-            insert_rule_result(conn, doc_id, rid, profile, severity, 1, "OK")
+            result_rows.append(rule_result_row(doc_id, rid, profile, severity, 1, "OK"))
 
         total += 1
 
+    conn.executemany(SQL_INSERT_VIOLATION, viol_rows)
+    conn.executemany(SQL_INSERT_RULE_RESULT, result_rows)
     conn.commit(); conn.close()
     return {
         "doc_id": doc_id,
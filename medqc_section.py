@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import argparse, re, sys
+import argparse, re
 import medqc_db as db
 import json
 from medqc_db import get_full_text
@@ -18,15 +18,25 @@ SECTION_PATTERNS = [
     ("Эпикриз", r"\b(Эпикриз|Выписной эпикриз|Переводной эпикриз)\b", "epicrisis", 70),
 ]
 
+# Дешёвый префильтр: подстроки (в нижнем регистре), без которых шаблон вида заведомо не совпадёт.
+# Регэксп запускается, только если в тексте есть хотя бы одна. При правке SECTION_PATTERNS — обновить.
+SECTION_PREFILTER = {
+    "admit":        ("поступлени", "госпитализаци"),
+    "triage":       ("триаж", "triage", "категория приоритета"),
+    "initial_exam": ("осмотр при поступлении", "первичный осмотр"),
+    "daily_note":   ("ежедневн", "дневниковая запись"),
+    "plan":         ("план лечения", "план обследования", "план ведения"),
+    "orders":       ("лист назначений", "назначения", "ордер"),
+    "vitals":       ("показатели здоровья", "температурный лист", "витальные", "t°", "чсс", "ад", "spo₂"),
+    "ecg":          ("экг", "ecg"),
+    "epicrisis":    ("эпикриз",),
+}
+
 
 def main():
-    
     ap = argparse.ArgumentParser(description="medqc-section — секционирование")
     ap.add_argument("--doc-id", required=True)
     args = ap.parse_args()
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--doc-id", required=True)
-    args = parser.parse_args()
 
     full = get_full_text(args.doc_id)
     if not full:
@@ -37,37 +47,41 @@ def main():
 
     # Собрать кандидаты: (name, kind, start, priority)
     candidates = []
+    low = full.lower()
     for name, rx, kind, prio in SECTION_PATTERNS:
+        if not any(k in low for k in SECTION_PREFILTER[kind]):
+            continue
         for m in re.finditer(rx, full, flags=re.I):
             candidates.append((name, kind, m.start(), prio))
 
     candidates.sort(key=lambda x: (x[2], -x[3]))
     # Строим непересекающиеся секции по первому в позиции (max priority уже учли)
+    # кандидаты отсортированы по start → ближайший занятый старт всегда последний
     final = []
-    taken_positions = []
+    last_taken = None
     for name, kind, start, prio in candidates:
-        if any(abs(start - s) < 2 for s in taken_positions):
+        if last_taken is not None and start - last_taken < 2:
             continue
-        taken_positions.append(start)
+        last_taken = start
         final.append((name, kind, start))
     final.sort(key=lambda x: x[2])
 
-    # Завершаем границы end по следующему старту
-    sections_rows = []
-    for i, (name, kind, start) in enumerate(final):
-        end = final[i+1][2] if i+1 < len(final) else len(full)
-        sections_rows.append({
-            "section_id": f"S{i+1}",
+    # Завершаем границы end по следующему старту (конец последней секции — конец текста)
+    ends = [start for _, _, start in final[1:]] + [len(full)]
+    sections_rows = [
+        {
+            "section_id": f"S{i}",
             "name": name,
             "kind": kind,
             "start": start,
             "end": end,
             "pageno": None
-        })
+        }
+        for i, ((name, kind, start), end) in enumerate(zip(final, ends), 1)
+    ]
 
     db.replace_sections(args.doc_id, sections_rows)
 
-    import json
     print(json.dumps({
         "doc_id": args.doc_id,
         "status": "sectioned",
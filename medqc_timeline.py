@@ -2,17 +2,24 @@
 import os
 import json
 import sqlite3
-from datetime import datetime
 from typing import Dict
 
+from medqc_db import db_file
+
 DB_PATH = os.getenv("MEDQC_DB", "/app/medqc.db")
 
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
+    # транзакции ведём вручную (BEGIN IMMEDIATE / COMMIT)
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
     conn.row_factory = sqlite3.Row
     return conn
 
+_schema_ready: set = set()  # файлы БД, где схема уже создана
+
 def ensure_schema(conn: sqlite3.Connection):
+    path = db_file(conn)
+    if path in _schema_ready:
+        return
     conn.executescript("""
     CREATE TABLE IF NOT EXISTS events(
       id         INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -24,6 +31,8 @@ def ensure_schema(conn: sqlite3.Connection):
     );
     """)
     conn.commit()
+    if path:  # БД в памяти у каждого соединения своя — не запоминаем
+        _schema_ready.add(path)
 
 # простая нормализация kind (на случай старых пайпов)
 def normalize_kind(k: str) -> str:
@@ -46,28 +55,39 @@ def run_timeline(doc_id: str) -> Dict[str,int]:
     conn = get_conn()
     ensure_schema(conn)
 
-    rows = conn.execute("SELECT id, kind, ts, payload FROM events WHERE doc_id=?", (doc_id,)).fetchall()
+    # в цикле нужны только id и kind — читаем кортежами, без sqlite3.Row
+    cur = conn.cursor()
+    cur.row_factory = None
+    rows = cur.execute("SELECT id, kind FROM events WHERE doc_id=?", (doc_id,)).fetchall()
     if not rows:
         conn.close()
         return {"doc_id": doc_id, "normalized": 0}
 
-    changed = 0
-    for r in rows:
-        kid = r["id"]
-        k = normalize_kind(r["kind"])
-        ts = r["ts"]
+    updates = []
+    for kid, kind in rows:
+        k = normalize_kind(kind)
         # если ts пусто и в payload есть подсказки — можно добавить, но оставим консервативно
-        if k != r["kind"]:
-            conn.execute("UPDATE events SET kind=? WHERE id=?", (k, kid))
-            changed += 1
+        if k != kind:
+            updates.append((k, kid))
         # очистим payload от мусора типа слишком длинного контекста (необязательно)
         # p = json.loads(r["payload"] or "{}")
         # if "context" in p and len(p["context"]) > 1000: p["context"] = p["context"][:1000]
         # conn.execute("UPDATE events SET payload=? WHERE id=?", (json.dumps(p, ensure_ascii=False), kid))
 
-    conn.commit()
+    # все обновления — одной транзакцией
+    if updates:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("UPDATE events SET kind=? WHERE id=?", updates)
+            conn.execute("COMMIT")
+        except Exception:
+            # если не удался сам BEGIN (БД занята) — откатывать нечего, пробрасываем исходную ошибку
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            conn.close()
+            raise
     conn.close()
-    return {"doc_id": doc_id, "normalized": changed}
+    return {"doc_id": doc_id, "normalized": len(updates)}
 
 def main():
     import argparse
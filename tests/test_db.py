@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+import medqc_db
+
+@pytest.fixture
+def conn(tmp_path):
+    c = medqc_db.connect(str(tmp_path / "medqc.db"))
+    medqc_db.ensure_schema(c)
+    yield c
+    c.close()
+
+def _doc(conn, doc_id):
+    return dict(conn.execute("SELECT * FROM docs WHERE doc_id=?", (doc_id,)).fetchone())
+
+def test_connect_reuses_connection_per_thread(tmp_path):
+    path = str(tmp_path / "medqc.db")
+    first = medqc_db.connect(path)
+    assert medqc_db.connect(str(tmp_path / "." / "medqc.db")) is first
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(medqc_db.connect(path)))
+    t.start(); t.join()
+    assert other[0] is not first
+
+    first.close()
+    again = medqc_db.connect(path)
+    assert again is not first
+    assert again.execute("SELECT 1").fetchone()[0] == 1
+    again.close()
+
+def test_connect_does_not_cache_memory_db():
+    assert medqc_db.connect(":memory:") is not medqc_db.connect(":memory:")
+
+def test_upsert_doc_insert_then_update(conn):
+    medqc_db.upsert_doc(conn, {"doc_id": "d1", "profile": "STA", "title": "Выписка", "content": "текст"})
+    row = _doc(conn, "d1")
+    assert (row["profile"], row["title"], row["content"]) == ("STA", "Выписка", "текст")
+    assert row["created_at"]
+
+    medqc_db.upsert_doc(conn, {"doc_id": "d1", "title": "Эпикриз"})
+    updated = _doc(conn, "d1")
+    assert updated["title"] == "Эпикриз"
+    # не переданные колонки и время создания не трогаются
+    assert (updated["profile"], updated["content"], updated["created_at"]) == ("STA", "текст", row["created_at"])
+    assert conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0] == 1
+
+def test_upsert_doc_rejects_unknown_columns(conn):
+    with pytest.raises(ValueError, match="nope"):
+        medqc_db.upsert_doc(conn, {"doc_id": "d1", "nope": 1})
+    assert conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0] == 0
+
+def test_upsert_doc_sees_columns_added_later(conn):
+    medqc_db.upsert_doc(conn, {"doc_id": "d1"})  # кэширует набор колонок
+    conn.execute("ALTER TABLE docs ADD COLUMN sha256 TEXT")
+    medqc_db.upsert_doc(conn, {"doc_id": "d1", "sha256": "abc"})
+    assert _doc(conn, "d1")["sha256"] == "abc"
+
+def _active(conn):
+    return conn.execute("SELECT package, version FROM rules_meta WHERE active=1 ORDER BY id").fetchall()
+
+def test_set_active_rules_package_keeps_one_active(conn):
+    conn.executemany("INSERT INTO rules_meta(package, version, active) VALUES (?,?,?)",
+                     [("kz", "1", 1), ("kz", "2", 0), ("ru", "1", 1)])
+    conn.commit()
+
+    medqc_db.set_active_rules_package(conn, "kz", "2")
+    assert [tuple(r) for r in _active(conn)] == [("kz", "2")]
+    assert medqc_db.get_active_rules_package(conn)["version"] == "2"
+
+    medqc_db.set_active_rules_package(conn, "ru", "1")
+    assert [tuple(r) for r in _active(conn)] == [("ru", "1")]
+
+    before = conn.total_changes
+    medqc_db.set_active_rules_package(conn, "ru", "1")  # уже активен — ничего не пишет
+    assert conn.total_changes == before
+
+def test_set_active_rules_package_without_commit(conn):
+    conn.execute("INSERT INTO rules_meta(package, version) VALUES ('kz', '1')")
+    conn.commit()
+    medqc_db.set_active_rules_package(conn, "kz", "1", commit=False)
+    assert conn.in_transaction
+    conn.rollback()
+    assert _active(conn) == []
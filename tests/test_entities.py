@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+import medqc_entities as E
+
+PHRASES = [
+    "Поступление 12.03.2025 10:15", "госпитализирован", "дата поступления: 12.03.2025 г. 09:00",
+    "выписан 20.03.2025", "выбыл", "Дата выписки 20/03/25 14:00", "Первичный осмотр",
+    "осмотр при поступлении 12.03.2025 11:00", "осмотр в приёмном", "осмотр в ПДО", "триаж",
+    "сортировка", "ПДО", "приемное отделение", "ЭКГ", "экг 13.03.2025 08:00", "ОАК",
+    "общий анализ крови", "биохимия", "СРБ", "CRP", "коагулограмма", "Выписной эпикриз 20.03.2025",
+    "эпикриз выписной", "Лист назначений", "назначено:", "назначены ", "\n13.03.2025 09:30 Жалобы нет",
+    "\n\n14.03.2025 г. 10:00 Состояние удовл.", "\n14.03.2025 18:00 осмотр дежурного",
+    "\n15-03-2025 9:05 температура", "назначено: ЭКГ, ОАК", "выписанный", "текст", "пациент",
+    "12.03.2025", "\n", "Температура 36.6", "АД 120/80",
+]
+
+def _corpus():
+    rnd = random.Random(20250317)
+    texts = [" ".join(rnd.choice(PHRASES) for _ in range(rnd.randint(1, 80))) for _ in range(200)]
+    texts += [t.upper() for t in texts[:50]]
+    texts += ["12.03.2025 10:00 жалобы нет", "ЭКГ", ""]
+    return texts
+
+CORPUS = _corpus()
+GROUPS = [p[0] for p in E._PASSES]
+
+@pytest.mark.parametrize("group", GROUPS)
+def test_scan_all_matches_per_pass_extract(group):
+    for text in CORPUS:
+        assert E.scan_all(text)[group] == E._extract(text, group)
+
+def test_master_first_chars_cover_every_pass():
+    # каждое совпадение отдельного прохода начинается с символа из MASTER_FIRST_CHARS или с начала текста
+    for text in CORPUS:
+        for group in GROUPS:
+            for m in E._RE_BY_GROUP[group].finditer(text):
+                assert m.start() == 0 or text[m.start()].lower() in E.MASTER_FIRST_CHARS, (group, m.group())
+
+def test_extract_wrappers_use_the_same_passes():
+    text = CORPUS[0]
+    hits = E.scan_all(text)
+    assert E.extract_admit(text) == hits["admit"]
+    assert E.extract_labs(text) == [h for i in range(len(E.LAB_KEYS)) for h in hits[f"lab{i}"]]
+
+def test_ensure_schema_runs_for_each_database(tmp_path):
+    import sqlite3
+    for name in ("a.db", "b.db"):
+        conn = sqlite3.connect(tmp_path / name)
+        E.ensure_schema(conn)
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        assert {"events", "entities"} <= tables
+        conn.close()
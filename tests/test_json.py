@@ -0,0 +1,50 @@
+import importlib
+import json
+import sys
+
+import pytest
+
+import medqc_db
+
+@pytest.fixture(params=["orjson", "json"])
+def codec(request, monkeypatch):
+    # оба варианта medqc_db.json_dumps/json_loads: с orjson и запасной на json
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setitem(sys.modules, "orjson", None)
+    mod = importlib.reload(medqc_db)
+    yield mod.json_dumps, mod.json_loads
+    monkeypatch.undo()
+    importlib.reload(medqc_db)
+
+VALUES = [
+    {},
+    [],
+    {"context": "Поступил 12.03.2025 10:15", "test": "ECG"},
+    [{"rule_id": "STA-001"}, {"ref": "Приказ №27"}],
+    {"a": None, "b": True, "c": 1.5, "d": [1, 2, {"e": "ё"}]},
+    "строка",
+]
+
+@pytest.mark.parametrize("value", VALUES)
+def test_round_trip(codec, value):
+    dumps, loads = codec
+    assert loads(dumps(value)) == value
+
+def test_non_str_keys_become_strings(codec):
+    dumps, loads = codec
+    assert loads(dumps({1: "a", 2: {3: "b"}})) == {"1": "a", "2": {"3": "b"}}
+
+def test_compact_utf8_format(codec):
+    # формат хранимого JSON: без пробелов после разделителей, кириллица без \u-экранирования
+    dumps, _ = codec
+    assert dumps({"a": [1, "й"], "b": {"c": None}}) == '{"a":[1,"й"],"b":{"c":null}}'
+
+@pytest.mark.parametrize("old", [
+    json.dumps({"a": [1, "й"]}, ensure_ascii=False),
+    json.dumps({"a": [1, "й"]}),
+])
+def test_reads_json_written_before_the_format_change(codec, old):
+    _, loads = codec
+    assert loads(old) == {"a": [1, "й"]}
@@ -0,0 +1,88 @@
+import importlib
+import json
+
+import pytest
+
+import medqc_db
+import medqc_norms_admin
+
+def _write_rules(path, rules, package="kz-standards", version="2025-09-17"):
+    path.write_text(json.dumps({"package": package, "version": version, "rules": rules}, ensure_ascii=False),
+                    encoding="utf-8")
+    return str(path)
+
+def _rules(n, **extra):
+    return [dict({"id": f"STA-{i:03d}", "profile": "STA", "severity": "major", "params": {"h": i}}, **extra)
+            for i in range(n)]
+
+@pytest.fixture
+def conn(tmp_path):
+    c = medqc_db.connect(str(tmp_path / "medqc.db"))
+    medqc_db.ensure_schema(c)
+    yield c
+    c.close()
+
+def _secondary_index_sql(conn):
+    return sorted(tuple(r) for r in conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name='rules' AND sql IS NOT NULL"))
+
+@pytest.fixture
+def low_defer_threshold(monkeypatch):
+    # порог через переменную окружения, как в проде; модуль читает её при импорте
+    monkeypatch.setenv("MEDQC_DEFER_INDEX_MIN_RULES", "1")
+    mod = importlib.reload(medqc_norms_admin)
+    assert mod.DEFER_INDEX_MIN_RULES == 1
+    yield mod
+    monkeypatch.undo()
+    importlib.reload(medqc_norms_admin)
+
+def test_deferred_indexes_are_rebuilt_intact(conn, tmp_path, low_defer_threshold):
+    before = _secondary_index_sql(conn)
+    assert [name for name, _ in before] == ["idx_rules_enabled", "idx_rules_enabled_profile", "idx_rules_profile"]
+
+    res = low_defer_threshold.migrate(conn, _write_rules(tmp_path / "rules.json", _rules(5)))
+
+    assert res["inserted"] == 5
+    assert _secondary_index_sql(conn) == before
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM rules WHERE enabled=1 AND profile=? ORDER BY rule_id",
+                        ("STA",)).fetchall()
+    assert "idx_rules_enabled_profile" in plan[0][3]
+    # UNIQUE-индекс не трогается — повторный импорт остаётся upsert'ом
+    low_defer_threshold.migrate(conn, _write_rules(tmp_path / "rules.json", _rules(5)))
+    assert conn.execute("SELECT COUNT(*) FROM rules").fetchone()[0] == 5
+
+def test_failed_import_keeps_indexes(conn, tmp_path, low_defer_threshold):
+    before = _secondary_index_sql(conn)
+    # profile у правила — объект: sqlite3 не умеет его привязать, executemany падает после DROP INDEX
+    with pytest.raises(Exception):
+        low_defer_threshold.migrate(conn, _write_rules(tmp_path / "rules.json", _rules(3, profile={"bad": 1})))
+    assert _secondary_index_sql(conn) == before
+    assert conn.execute("SELECT COUNT(*) FROM rules").fetchone()[0] == 0
+
+def test_migrate_counts_and_activation(conn, tmp_path):
+    # правило без id пропускается, но входит в общее число правил файла
+    path = _write_rules(tmp_path / "rules.json", _rules(3) + [{"profile": "STA", "severity": "minor"}])
+    res = medqc_norms_admin.migrate(conn, path)
+    assert (res["rules"], res["inserted"], res["updated"]) == (4, 3, 0)
+    assert res["status"] == "imported_and_activated"
+    assert conn.execute("SELECT COUNT(*) FROM rules").fetchone()[0] == 3
+    assert medqc_db.get_active_rules_package(conn)["package"] == "kz-standards"
+
+    # повторный импорт без изменений: всё считается обновлением, но строки не переписываются
+    before = conn.total_changes
+    res = medqc_norms_admin.migrate(conn, path)
+    assert (res["inserted"], res["updated"]) == (0, 3)
+    assert conn.total_changes == before
+
+    # изменённое правило и новое
+    rules = _rules(4)
+    rules[0]["severity"] = "critical"
+    res = medqc_norms_admin.migrate(conn, _write_rules(tmp_path / "rules.json", rules))
+    assert (res["inserted"], res["updated"]) == (1, 3)
+    assert conn.execute("SELECT severity FROM rules WHERE rule_id='STA-000'").fetchone()[0] == "critical"
+
+def test_migrate_switches_active_package(conn, tmp_path):
+    medqc_norms_admin.migrate(conn, _write_rules(tmp_path / "a.json", _rules(1), version="1"))
+    medqc_norms_admin.migrate(conn, _write_rules(tmp_path / "b.json", _rules(1), version="2"))
+    assert [tuple(r) for r in conn.execute("SELECT version FROM rules_meta WHERE active=1")] == [("2",)]
@@ -0,0 +1,25 @@
+import json
+import sys
+
+import medqc_report
+
+PAYLOAD = {
+    "doc_id": "KZ-1",
+    "violations": [{"rule_id": "STA-001", "message": "Нет первичного осмотра", "sources_json": '[{"rule_id":"STA-001"}]'}],
+    "generated_at": "2025-09-17T10:00:00Z",
+}
+
+def _run(monkeypatch, *argv):
+    monkeypatch.setattr(medqc_report.db, "init_schema", lambda: None, raising=False)
+    monkeypatch.setattr(medqc_report, "build_json_report", lambda *a: PAYLOAD)
+    monkeypatch.setattr(sys, "argv", ["medqc_report.py", "--doc-id", "KZ-1", *argv])
+    medqc_report.main()
+
+def test_json_out_file_stays_indented(tmp_path, monkeypatch):
+    out = tmp_path / "report.json"
+    _run(monkeypatch, "--format", "json", "--out", str(out))
+    assert out.read_text(encoding="utf-8") == json.dumps(PAYLOAD, ensure_ascii=False, indent=2)
+
+def test_json_stdout_matches_out_file(tmp_path, monkeypatch, capsys):
+    _run(monkeypatch, "--format", "json")
+    assert capsys.readouterr().out == json.dumps(PAYLOAD, ensure_ascii=False, indent=2) + "\n"
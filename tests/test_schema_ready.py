@@ -0,0 +1,17 @@
+import sqlite3
+
+import pytest
+
+import medqc_extract
+import medqc_timeline
+
+@pytest.mark.parametrize("ensure, table", [
+    (medqc_extract.ensure_text_tables, "artifacts"),
+    (medqc_timeline.ensure_schema, "events"),
+])
+def test_schema_is_created_in_every_database(tmp_path, ensure, table):
+    for name in ("a.db", "b.db"):
+        conn = sqlite3.connect(tmp_path / name)
+        ensure(conn)
+        assert conn.execute("SELECT 1 FROM sqlite_master WHERE name=?", (table,)).fetchone()
+        conn.close()